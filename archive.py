@@ -0,0 +1,152 @@
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import os
+import threading
+import time
+import urllib.parse
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from listing import Listing
+from pipeline import InitParseWorker
+
+ArchiveEntry = collections.namedtuple("ArchiveEntry", ["url", "fetched", "offset", "length", "sha1"])
+
+# Archives for the same directory share a lock and the content hash of the
+# latest copy of each url, since every Scraper builds its own PageArchive.
+_locks: Dict[str, threading.Lock] = collections.defaultdict(threading.Lock)
+_latest_hashes: Dict[str, Dict[str, str]] = {}
+
+
+def ArchiveDir(host: str) -> str:
+    """Where pages fetched from host are archived.
+
+    /tmp is instance memory on App Engine, so ARCHIVE_DIR can point somewhere
+    with more room.
+    """
+    return os.path.join(os.environ.get("ARCHIVE_DIR", "/tmp"), "archive-%s" % host)
+
+
+class PageArchive(object):
+    """Append-only archive of raw fetched pages.
+
+    Each response body is zlib-compressed and appended to `pages.dat`; a line
+    of url, fetch time, offset, length and content hash is appended to
+    `index.tsv`. Nothing is ever rewritten. A page whose body is the same as
+    the latest archived copy of its url is not stored again, so repeated
+    crawls only grow the archive by what changed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.data_path = os.path.join(directory, "pages.dat")
+        self.index_path = os.path.join(directory, "index.tsv")
+        self.key = os.path.abspath(directory)
+        self.lock = _locks[self.key]
+
+    def _LatestHashes(self) -> Dict[str, str]:
+        # Called with the lock held. Reads the index once per process.
+        if self.key not in _latest_hashes:
+            _latest_hashes[self.key] = {e.url: e.sha1 for e in self.Latest()}
+        return _latest_hashes[self.key]
+
+    def Append(self, url: str, content: bytes, fetched: Optional[float] = None) -> bool:
+        """Returns False if the content was unchanged since the last copy and was not stored."""
+        if fetched is None:
+            fetched = time.time()
+        sha1 = hashlib.sha1(content).hexdigest()
+        with self.lock:
+            latest = self._LatestHashes()
+            if latest.get(url) == sha1:
+                return False
+            compressed = zlib.compress(content)
+            with open(self.data_path, "ab") as f:
+                offset = f.tell()
+                f.write(compressed)
+            with open(self.index_path, "a") as f:
+                f.write("%s\t%.3f\t%d\t%d\t%s\n" % (url, fetched, offset, len(compressed), sha1))
+            latest[url] = sha1
+        return True
+
+    def Entries(self) -> Iterator[ArchiveEntry]:
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path) as f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) != 5:
+                    print("ERROR: Bad archive index line [%s]" % line)
+                    continue
+                yield ArchiveEntry(parts[0], float(parts[1]), int(parts[2]), int(parts[3]), parts[4])
+
+    def Latest(self, before: Optional[float] = None) -> List[ArchiveEntry]:
+        """Returns the most recent entry for every url, optionally only those fetched before a time."""
+        latest: Dict[str, ArchiveEntry] = {}
+        for entry in self.Entries():
+            if before is not None and entry.fetched >= before:
+                continue
+            if entry.url not in latest or entry.fetched >= latest[entry.url].fetched:
+                latest[entry.url] = entry
+        return sorted(latest.values(), key=lambda e: e.url)
+
+    def Read(self, entry: ArchiveEntry) -> bytes:
+        return ReadArchived(self.data_path, entry.offset, entry.length)
+
+
+def ReadArchived(data_path: str, offset: int, length: int) -> bytes:
+    with open(data_path, "rb") as f:
+        f.seek(offset)
+        return zlib.decompress(f.read(length))
+
+
+def ReparseArchived(task: Tuple[str, str, int, int]) -> List[Listing]:
+    """Parses one archived page into listings. Runs in a worker process."""
+    from bs4 import BeautifulSoup
+    from fetcher import IsListingSoup, ParseListingSoup
+    data_path, url, offset, length = task
+    soup = BeautifulSoup(ReadArchived(data_path, offset, length), "html.parser")
+    if not IsListingSoup(soup):
+        return []
+    link = urllib.parse.urlsplit(url).path
+    return list(ParseListingSoup(soup, link))
+
+
+def Reparse(archive: PageArchive, workers: Optional[int] = None, before: Optional[float] = None,
+            locale_name="ja_JP.UTF-8") -> Iterator[Listing]:
+    """Re-parses the latest archived copy of every page with a process pool."""
+    tasks = [(archive.data_path, e.url, e.offset, e.length) for e in archive.Latest(before)]
+    print("Re-parsing %d archived pages" % len(tasks))
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=InitParseWorker, initargs=(locale_name,)) as pool:
+        for listings in pool.map(ReparseArchived, tasks, chunksize=16):
+            yield from listings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuilds the listing cache from the raw page archive.")
+    parser.add_argument("--host", default="tomigaya.jp")
+    parser.add_argument("--archive", help="Defaults to $ARCHIVE_DIR/archive-<host>, with ARCHIVE_DIR defaulting to /tmp.")
+    parser.add_argument("--cache", help="Defaults to /tmp/cache-<host>.")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--before", type=float, default=None,
+                        help="Only use pages fetched before this unix time.")
+    args = parser.parse_args()
+
+    from fetcher import ListingCache
+    archive = PageArchive(args.archive or ArchiveDir(args.host))
+    cache = ListingCache(args.cache or "/tmp/cache-%s" % args.host, None)
+    start = time.time()
+    written = 0
+    for listing in Reparse(archive, args.workers, args.before):
+        if listing.id() is None:
+            continue
+        cache._WriteToCache(listing)
+        written += 1
+    print("Wrote %d listings to %s in %.1fs" % (written, cache.directory, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
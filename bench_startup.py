@@ -0,0 +1,51 @@
+import argparse
+import json
+import subprocess
+import sys
+from typing import Dict, List
+
+# Run in a fresh interpreter each time so that nothing is already imported.
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+heavy = sorted(m for m in ("bs4", "jsonpickle", "sendgrid", "googleapiclient", "oauth2client", "httpcache")
+               if m in sys.modules)
+result = dict(import_s=imported - start, heavy_loaded=heavy)
+if %(warmup)r:
+    client = main.app.test_client()
+    t = time.perf_counter()
+    response = client.get("/_ah/warmup")
+    result["warmup_s"] = time.perf_counter() - t
+    result["warmup_status"] = response.status_code
+print(json.dumps(result))
+"""
+
+
+def Probe(warmup: bool) -> Dict:
+    output = subprocess.check_output([sys.executable, "-c", _PROBE % dict(warmup=warmup)])
+    return json.loads(output.decode().strip().split("\n")[-1])
+
+
+def Summarize(values: List[float]) -> str:
+    values = sorted(values)
+    return "min %.3fs  median %.3fs  max %.3fs" % (values[0], values[len(values) // 2], values[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures cold import and warmup latency of main.py.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--warmup", action="store_true",
+                        help="Also time /_ah/warmup (needs token.json for the Sheets client).")
+    args = parser.parse_args()
+    results = [Probe(args.warmup) for _ in range(args.runs)]
+    print("import main:    %s" % Summarize([r["import_s"] for r in results]))
+    print("loaded eagerly: %s" % (results[0]["heavy_loaded"] or "none"))
+    if args.warmup:
+        print("/_ah/warmup:    %s  (status %s)" % (
+            Summarize([r["warmup_s"] for r in results]), results[0]["warmup_status"]))
+
+
+if __name__ == "__main__":
+    main()
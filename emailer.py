@@ -1,46 +1,19 @@
-from listing import Listing
-from typing import List, Set
+from listing import Listing, ParsedNumber
+from outbox import LocalTransport, Outbox, SentLog
+from typing import Dict, List
 import os
+import threading
 import traceback
 import smtplib
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
 from email.message import EmailMessage
 
 
-class Emailer(object):
-    def __init__(self, host, logfile):
-        self.host = host
-        self.logfile = logfile
-        if not os.path.exists(logfile):
-            open(logfile, "w")
-
-    def _ReadLog(self) -> List[str]:
-        with open(self.logfile) as f:
-            return list(f.read().split("\n"))
-
-    def _WriteLog(self, entries: List[str]):
-        with open(self.logfile, "w") as f:
-            f.write("\n".join(entries))
-
-    def _RenderToHtml(self, listing: Listing) -> str:
-        return """
-        <h2><a href="http://{host}{link}">{title}</h2>
-        <p>{msq} {ldk} {rent} <a href="google.com/maps/place/{address}">{address}</a>
-        <br>
-        """.format(
-            host=self.host,
-            link=listing.link,
-            title=listing.name,
-            msq=listing.msq.text,
-            rent=listing.rent.text,
-            ldk=listing.ldk,
-            address=listing.address,
-        )
-
-    def _DoSend(self, contents: List[str]) -> bool:
+class SendGridTransport(object):
+    def Send(self, contents: List[str]) -> bool:
         if not contents:
             return True
+        from sendgrid import SendGridAPIClient
+        from sendgrid.helpers.mail import Mail
         msg = EmailMessage()
         contents = ["<strong>いい物件が%d件見つかったけん！</strong>" % len(contents)] + contents
         html_content = "<br>".join(contents)
@@ -72,27 +45,75 @@ class Emailer(object):
             print(traceback.format_exc())
         return False
 
+
+# One outbox (and sender thread) per log file, shared by all Emailers in the process.
+_outboxes: Dict[str, Outbox] = {}
+_outboxes_lock = threading.Lock()
+
+
+def GetOutbox(logfile, transport=None) -> Outbox:
+    """Returns the outbox for logfile, creating it with transport on first use.
+
+    Without a transport, the outbox uses LocalTransport if EMAIL_LOCAL_DIR is
+    set and SendGrid otherwise. Asking for a different transport once the
+    outbox exists raises ValueError rather than sending through the old one.
+    """
+    with _outboxes_lock:
+        if logfile in _outboxes:
+            existing = _outboxes[logfile].transport
+            if transport is not None and transport is not existing:
+                raise ValueError("Outbox for %s already sends through %s, not %s" % (
+                    logfile, type(existing).__name__, type(transport).__name__))
+        else:
+            if transport is None:
+                transport = (LocalTransport(os.environ["EMAIL_LOCAL_DIR"])
+                             if os.environ.get("EMAIL_LOCAL_DIR") else SendGridTransport())
+            _outboxes[logfile] = Outbox(SentLog(logfile), transport)
+        return _outboxes[logfile]
+
+
+class Emailer(object):
+    def __init__(self, host, logfile, transport=None):
+        self.host = host
+        self.logfile = logfile
+        self.outbox = GetOutbox(logfile, transport)
+
+    def _RenderToHtml(self, listing: Listing) -> str:
+        return """
+        <h2><a href="http://{host}{link}">{title}</h2>
+        <p>{msq} {ldk} {rent} <a href="google.com/maps/place/{address}">{address}</a>
+        <br>
+        """.format(
+            host=self.host,
+            link=listing.link,
+            title=listing.name,
+            msq=listing.msq.text,
+            rent=listing.rent.text,
+            ldk=listing.ldk,
+            address=listing.address,
+        )
+
     def MaybeSend(self, listings: List[Listing]) -> int:
-        log = self._ReadLog()
-        log_uniq = set(log)
-        contents: List[str] = []
+        """Queues listings not emailed yet; returns without waiting for delivery."""
+        queued = 0
         for listing in listings:
             id = listing.id()
-            if id in log_uniq:
-                print("Email already sent for id %s" % id)
+            if not self.outbox.Enqueue(id, self._RenderToHtml(listing)):
+                print("Email already sent or queued for id %s" % id)
                 continue
-            print("Email not yet sent for id %s" % id)
-            contents.append(self._RenderToHtml(listing))
-            log.append(id)
-        if self._DoSend(contents):
-            self._WriteLog(sorted(log))
-        return len(contents)
+            print("Email queued for id %s" % id)
+            queued += 1
+        return queued
 
 
 def main():
-    emailer = Emailer("example.org", "/tmp/oneoff.log")
-    emailer._DoSend(["hello過ぎる"])
-    # emailer.MaybeSend([Listing("/id/1234", "Good house", roomnumber="1234")])
+    # Renders and queues a digest without sending real email; the html lands in /tmp/oneoff-mail.
+    emailer = Emailer("example.org", "/tmp/oneoff.log", LocalTransport("/tmp/oneoff-mail"))
+    emailer.MaybeSend([Listing(link="/id/1234", name="Good house", roomnumber="1234",
+                               msq=ParsedNumber.Parse("70m²", "m²"), rent=ParsedNumber.Parse("300000円", "円"))])
+    emailer.outbox.Flush(timeout=30)
+    print("Digests: %s" % emailer.outbox.transport.sent)
+    # SendGridTransport().Send(["hello過ぎる"])
 
 
 if __name__ == "__main__":
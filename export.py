@@ -0,0 +1,110 @@
+import csv
+import io
+import itertools
+import json
+from typing import Any, Dict, Iterable, Iterator, List
+
+from listing import LISTING_FIELDS, Listing
+
+# Internal bookkeeping fields are left out of exports.
+EXPORT_FIELDS = ["id"] + [f for f in LISTING_FIELDS if not f.endswith("_internal")]
+
+FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/octet-stream", "parquet"),
+}
+
+
+def ToRecord(listing: Listing) -> Dict[str, Any]:
+    """Flattens a listing into plain values. Parsed numbers become their value, or None if unparsed."""
+    record: Dict[str, Any] = {}
+    for field in EXPORT_FIELDS:
+        if field == "id":
+            record["id"] = listing.id()
+            continue
+        value = getattr(listing, field)
+        if hasattr(value, "parsed"):
+            value = value.value if value.parsed else None
+        elif field == "images":
+            value = " ".join(value or [])
+        elif hasattr(value, "isoformat"):
+            value = value.isoformat()
+        elif value is not None and not isinstance(value, (str, int, float, bool)):
+            value = str(value)
+        record[field] = value
+    return record
+
+
+def Chunks(listings: Iterable[Listing], size: int) -> Iterator[List[Dict[str, Any]]]:
+    it = iter(listings)
+    while True:
+        chunk = [ToRecord(l) for l in itertools.islice(it, size)]
+        if not chunk:
+            return
+        yield chunk
+
+
+def StreamNdjson(listings: Iterable[Listing], chunk_size=500) -> Iterator[str]:
+    for chunk in Chunks(listings, chunk_size):
+        yield "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in chunk)
+
+
+def StreamCsv(listings: Iterable[Listing], chunk_size=500) -> Iterator[str]:
+    out = io.StringIO()
+    writer = csv.DictWriter(out, EXPORT_FIELDS)
+    writer.writeheader()
+    for chunk in Chunks(listings, chunk_size):
+        writer.writerows(chunk)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    if out.getvalue():
+        yield out.getvalue()
+
+
+def WriteParquet(listings: Iterable[Listing], path: str, chunk_size=5000) -> int:
+    """Writes one row group per chunk. Returns the number of rows written.
+
+    Needs pyarrow, which is optional and not in requirements.txt; install it
+    where Parquet export is wanted. Raises ImportError without it.
+    """
+    import pyarrow
+    import pyarrow.parquet
+    numeric = {"rent", "msq"}
+    schema = pyarrow.schema([
+        (f, pyarrow.float64() if f in numeric else pyarrow.bool_() if f in ("active", "grentable")
+         else pyarrow.string())
+        for f in EXPORT_FIELDS])
+    rows = 0
+    with pyarrow.parquet.ParquetWriter(path, schema, compression="snappy") as writer:
+        for chunk in Chunks(listings, chunk_size):
+            columns = [[r[f] for r in chunk] for f in EXPORT_FIELDS]
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(c, type=t) for c, t in zip(columns, schema.types)], schema=schema))
+            rows += len(chunk)
+    return rows
+
+
+def main():
+    import argparse
+    import sys
+    from store import IterDb
+    parser = argparse.ArgumentParser(description="Exports a local listing db written by /scrape-db.")
+    parser.add_argument("db")
+    parser.add_argument("--format", default="ndjson", choices=sorted(FORMATS))
+    parser.add_argument("--out", help="Output path, required for parquet. Defaults to stdout.")
+    args = parser.parse_args()
+    if args.format == "parquet":
+        if not args.out:
+            parser.error("--out is required for parquet")
+        print("Wrote %d rows to %s" % (WriteParquet(IterDb(args.db), args.out), args.out))
+        return
+    stream = StreamNdjson if args.format == "ndjson" else StreamCsv
+    out = open(args.out, "w") if args.out else sys.stdout
+    for piece in stream(IterDb(args.db)):
+        out.write(piece)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,100 @@
 import os
+import re
 import collections
-import jsonpickle
 from listing import Listing, NormalizeValue, ParsedNumber
-from typing import Optional, List
-from bs4 import BeautifulSoup
+from pipeline import FetchPipeline
+from typing import Iterable, Iterator, Optional, List, Tuple
+
+
+def IsListingSoup(soup) -> bool:
+    """False for building pages, whose room table Fetch expands instead of parsing the page."""
+    return not soup.find("div", class_="table_area scroll-area")
+
+
+def ExtractUnitLinks(soup) -> List[str]:
+    rooms_table = soup.find("div", class_="table_area scroll-area")
+    unit_links = set()
+    for row in rooms_table.find_all("tr"):
+        a_elem = row.find_next("td").find("a")
+        unit_links.add(a_elem["href"])
+    return sorted(unit_links)
+
+
+def ParseSerpSoup(soup) -> Tuple[List[str], Optional[str]]:
+    """Returns the listing links on a search result page and the link to the next page, if any."""
+    links = []
+    result_list = soup.find("div", class_="result_list")
+    assert result_list
+    for result in result_list.find_all("div", class_="base"):
+        room_table = result.find("table", class_="room")
+        if room_table:
+            for row in room_table.find_all("tr", class_="clickableRow"):
+                match = re.match(r"location.href='(.*)';", row["onclick"])
+                if not match:
+                    print("ERROR: invalid onclick string: [%s]" % row["onclick"])
+                    continue
+                links.append(match.group(1))
+        else:
+            link_a = result.find("a")
+            if not link_a:
+                print("No link in result: [%s]" % result)
+            assert link_a
+            link = link_a["href"]
+            print("ERROR: No room table in result, falling back to building-level link [%s]" % link)
+            links.append(link)
+    pager = soup.find("div", class_="pager")
+    next_li = pager.find("li", class_="next")
+    next_a = next_li.find("a")
+    if not next_a:
+        print("This was the last page of results")
+        return links, None
+    return links, next_a["href"]
+
+
+def ParseListingSoup(soup, link: str) -> Listing:
+    table = soup.find("table", summary="建物詳細")
+    if not table:
+        return
+    details = collections.defaultdict(str)
+    for row in table.find_all("tr"):
+        key, value = row.find("th"), row.find("td")
+        if not key or not value:
+            continue
+        details[key.text] = NormalizeValue(value.find(text=True, recursive=False))
+    images = [e["href"] for e in soup.find_all("a", class_="sp-slide-fancy")]
+    #print(details)
+    yield Listing(
+        link=link,
+        roomnumber=details["部屋番号"],
+        ldk=details["間取り"],
+        name=details["物件名称"],
+        msq=ParsedNumber.Parse(details["専有面積"], "m²"),
+        rent=ParsedNumber.Parse(details["賃料"], "円"),
+        leaseterm=details["契約期間"],
+        address=details["所在地"],
+        images=images,
+        build=details["構造"],
+        year=details["築年月"],
+    )
+
 
 class Fetcher(object):
-    def __init__(self, session, host):
+    def __init__(self, session, host, archive=None):
         self.session = session
         self.host = host
+        self.archive = archive
+        self.pipeline = FetchPipeline(lambda url: self._Get(url).content, host)
+
+    def _Get(self, url):
+        page = self.session.get(url)
+        if self.archive is not None:
+            self.archive.Append(url, page.content)
+        return page
 
     def _ParseListingPage(self, page, link: str) -> Listing:
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(page.content, "html.parser")
-        table = soup.find("table", summary="建物詳細")
-        if not table:
-            return
-        details = collections.defaultdict(str)
-        for row in table.find_all("tr"):
-            key, value = row.find("th"), row.find("td")
-            if not key or not value:
-                continue
-            details[key.text] = NormalizeValue(value.find(text=True, recursive=False))
-        images = [e["href"] for e in soup.find_all("a", class_="sp-slide-fancy")]
-        #print(details)
-        yield Listing(
-            link=link,
-            roomnumber=details["部屋番号"],
-            ldk=details["間取り"],
-            name=details["物件名称"],
-            msq=ParsedNumber.Parse(details["専有面積"], "m²"),
-            rent=ParsedNumber.Parse(details["賃料"], "円"),
-            leaseterm=details["契約期間"],
-            address=details["所在地"],
-            images=images,
-            build=details["構造"],
-            year=details["築年月"],
-        )
+        yield from ParseListingSoup(soup, link)
 
     def _ParseSerp(self, link, soup):
         print("ParseSerp %s %s" % (link, soup))
@@ -45,25 +104,30 @@ class Fetcher(object):
     def Fetch(self, link):
         url = "http://%s%s" % (self.host, link)
         print("Fetching %s" % url)
-        page = self.session.get(url)
+        page = self._Get(url)
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(page.content, "html.parser")
         rooms_table = soup.find("div", class_="table_area scroll-area")
         serp_list = soup.find("div", class_="result_list")
         if serp_list:
             yield from self._ParseSerp(link, soup)
         if rooms_table:
-            unit_links = set()
-            for row in rooms_table.find_all("tr"):
-                a_elem = row.find_next("td").find("a")
-                unit_links.add(a_elem["href"])
-            for unit_link in sorted(unit_links):
+            for unit_link in ExtractUnitLinks(soup):
                 unit_url = "http://%s%s" % (self.host, unit_link)
                 print("Fetching unit page %s" % unit_url)
-                unit_page = self.session.get(unit_url)
+                unit_page = self._Get(unit_url)
                 yield from self._ParseListingPage(unit_page, unit_link)
         else:
             yield from self._ParseListingPage(page, link)
 
+    def FetchMany(self, links: Iterable[str]) -> Iterator[Listing]:
+        """Like Fetch for each link, but fetching and parsing run concurrently. Yields in completion order."""
+        return self.pipeline.Run(("page", link) for link in links)
+
+    def FetchSerp(self, link: str) -> Iterator[Listing]:
+        """Yields summaries from the search result page at link and all the pages after it."""
+        return self.pipeline.Run([("serp", link)])
+
 
 class ListingCache(object):
     def __init__(self, directory, fetcher):
@@ -85,27 +149,40 @@ class ListingCache(object):
         #    print("Building %s --> %s" % (b, ids))
 
     def _ReadRoomCached(self, id) -> Listing:
+        import jsonpickle
         with open(os.path.join(self.directory, id)) as f:
             return jsonpickle.decode(f.read())
 
     def _ReadBuildingCached(self, building_id) -> List[Listing]:
         return [self._ReadRoomCached(id) for id in self.building_ids[building_id]]
 
+    def IterCached(self) -> Iterator[Listing]:
+        """Yields every cached listing, reading one file at a time."""
+        for id in sorted(self.ids):
+            yield self._ReadRoomCached(id)
+
     def _WriteToCache(self, listing: Listing):
+        import jsonpickle
         with open(os.path.join(self.directory, listing.id()), "w") as f:
             f.write(jsonpickle.encode(listing))
 
-    def FetchCached(self, link) -> Optional[List[Listing]]:
-        parts = Listing.parselink(link)
-        if parts is None:
-            return None
-        building, room = parts
+    def _ReadCached(self, link) -> Optional[List[Listing]]:
+        """Returns the cached listings for link, or None on a cache miss."""
+        building, room = Listing.parselink(link)
         if room is None and building in self.building_ids.keys():
             return self._ReadBuildingCached(building)
         if room is not None:
             id = "___".join([building, room])
             if id in self.ids:
                 return [self._ReadRoomCached(id)]
+        return None
+
+    def FetchCached(self, link) -> Optional[List[Listing]]:
+        if Listing.parselink(link) is None:
+            return None
+        cached = self._ReadCached(link)
+        if cached is not None:
+            return cached
 
         # Cache miss
         listings = list(self.fetcher.Fetch(link))
@@ -115,6 +192,29 @@ class ListingCache(object):
         self._Refresh()
         return listings
 
+    def FetchCachedMany(self, links: Iterable[str]) -> Iterator[Listing]:
+        """Yields cached listings for all links, then fetches the misses through the fetch pipeline."""
+        misses = []
+        for link in links:
+            if Listing.parselink(link) is None:
+                continue
+            cached = self._ReadCached(link)
+            if cached is None:
+                misses.append(link)
+                continue
+            yield from cached
+        if not misses:
+            return
+        fetched = 0
+        for listing in self.fetcher.FetchMany(misses):
+            if listing.id() is None:
+                continue
+            self._WriteToCache(listing)
+            fetched += 1
+            yield listing
+        print("Fetched %d items for %d cache misses" % (fetched, len(misses)))
+        self._Refresh()
+
 
 def main():
     cache = ListingCache("/tmp/cache-tomigaya.jp", None)
@@ -0,0 +1,333 @@
+import array
+import collections
+import csv
+import datetime
+import os
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from listing import Listing
+
+# Flags byte of an event.
+_ACTIVE = 1
+_RENT_KNOWN = 2
+
+RentChange = collections.namedtuple("RentChange", ["id", "timestamp", "old", "new"])
+
+# Histories for the same directory share a lock, since every request builds its own.
+_locks: Dict[str, threading.Lock] = collections.defaultdict(threading.Lock)
+
+
+def LocalHistoryPath(host: str, subpath: str) -> str:
+    return "/tmp/history-%s%s" % (host, subpath.replace("/", "_"))
+
+
+def _FileSizes(directory) -> Tuple[int, int, int]:
+    paths = [os.path.join(directory, n) for n in ("ids.txt", "runs.bin", "events.bin")]
+    return tuple(os.path.getsize(p) if os.path.exists(p) else 0 for p in paths)
+
+
+def _ZigZag(n: int) -> int:
+    return (n << 1) ^ (n >> 63)
+
+
+def _UnZigZag(n: int) -> int:
+    return (n >> 1) ^ -(n & 1)
+
+
+def _EncodeVarint(n: int, out: bytearray):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _DecodeVarint(data: bytes, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _Seconds(timestamp) -> int:
+    if isinstance(timestamp, datetime.datetime):
+        return int(timestamp.timestamp())
+    return int(timestamp)
+
+
+def _Rent(listing: Listing) -> Optional[int]:
+    if listing.rent is None or not listing.rent.parsed:
+        return None
+    return int(round(listing.rent.value))
+
+
+class ListingHistory(object):
+    """Append-only time series of rent and active state per listing.
+
+    An event is written when a listing is first seen and whenever its rent or
+    active state changes; the time of every run is kept separately, so a
+    listing that stays the same costs nothing per run. A listing's first
+    event is dated by its `firstseen` and a deactivation by its `lastseen`,
+    so listings already in the db get their real time on market. Events are
+    stored as varints holding the difference in time and rent from the
+    previous event for the same listing, and are decoded into parallel
+    arrays on load.
+
+    Files in `directory`:
+      ids.txt    listing ids, one per line; the line number is the id number.
+      runs.bin   varint deltas between run times, in seconds.
+      events.bin varint (id number, time delta, zigzag rent delta) and a flags byte.
+
+    A record cut short by a crash mid-write is skipped on load. Loading never
+    writes; the file is only truncated back to the last complete record by
+    the next Record, before it appends.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = _locks[os.path.abspath(directory)]
+        with self.lock:
+            self._Load()
+
+    def _Path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _Sizes(self) -> Tuple[int, int, int]:
+        return _FileSizes(self.directory)
+
+    def _Truncate(self, name, size):
+        print("ERROR: Truncating incomplete record at byte %d of %s" % (size, self._Path(name)))
+        with open(self._Path(name), "r+b") as f:
+            f.truncate(size)
+
+    def _Load(self, repair=False):
+        """Reads all three files, stopping at an incomplete record. With repair, truncates it away."""
+        self.ids: List[str] = []
+        self.id_nums: Dict[str, int] = {}
+        self.runs = array.array("q")
+        self.event_ids = array.array("l")
+        self.event_times = array.array("q")
+        self.event_rents = array.array("q")  # -1 where unknown.
+        self.event_flags = array.array("b")
+        # id number -> (time, rent, flags) of its latest event, for delta encoding.
+        self.last: Dict[int, Tuple[int, int, int]] = {}
+        ids_size = runs_size = events_size = 0
+        if os.path.exists(self._Path("ids.txt")):
+            with open(self._Path("ids.txt"), "rb") as f:
+                data = f.read()
+            ids_size = data.rfind(b"\n") + 1
+            self.ids = [line for line in data[:ids_size].decode().split("\n") if line]
+            self.id_nums = {id: i for i, id in enumerate(self.ids)}
+        if os.path.exists(self._Path("runs.bin")):
+            with open(self._Path("runs.bin"), "rb") as f:
+                data = f.read()
+            pos, t = 0, 0
+            while pos < len(data):
+                try:
+                    delta, pos = _DecodeVarint(data, pos)
+                except IndexError:
+                    break
+                runs_size = pos
+                t += delta
+                self.runs.append(t)
+        if os.path.exists(self._Path("events.bin")):
+            with open(self._Path("events.bin"), "rb") as f:
+                data = f.read()
+            pos = 0
+            while pos < len(data):
+                start = pos
+                try:
+                    id_num, pos = _DecodeVarint(data, pos)
+                    dt, pos = _DecodeVarint(data, pos)
+                    drent, pos = _DecodeVarint(data, pos)
+                    flags = data[pos]
+                    pos += 1
+                except IndexError:
+                    break
+                if id_num >= len(self.ids):
+                    break
+                events_size = pos
+                prev_time, prev_rent, _ = self.last.get(id_num, (0, 0, 0))
+                self._AddEvent(id_num, prev_time + dt, prev_rent + _UnZigZag(drent), flags)
+        # Bytes of each file up to the end of its last complete record.
+        self.complete = (ids_size, runs_size, events_size)
+        if repair:
+            for name, size, complete in zip(("ids.txt", "runs.bin", "events.bin"), self._Sizes(), self.complete):
+                if complete < size:
+                    self._Truncate(name, complete)
+        self.sizes = self._Sizes()
+
+    def _AddEvent(self, id_num, t, rent, flags):
+        self.event_ids.append(id_num)
+        self.event_times.append(t)
+        self.event_rents.append(rent if flags & _RENT_KNOWN else -1)
+        self.event_flags.append(flags)
+        self.last[id_num] = (t, rent, flags)
+
+    def _EncodeEvent(self, id_num, t, rent, flags, out: bytearray):
+        prev_time, prev_rent, _ = self.last.get(id_num, (0, 0, 0))
+        t = max(t, prev_time)
+        _EncodeVarint(id_num, out)
+        _EncodeVarint(t - prev_time, out)
+        _EncodeVarint(_ZigZag(rent - prev_rent), out)
+        out.append(flags)
+        self._AddEvent(id_num, t, rent, flags)
+
+    def Record(self, timestamp, listings: Iterable[Listing]) -> int:
+        """Appends one run. Returns the number of events written."""
+        t = _Seconds(timestamp)
+        new_ids = []
+        events = bytearray()
+        written = 0
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            if self._Sizes() != self.sizes or self.complete != self.sizes:
+                # Another instance wrote since this one loaded, so the delta bases are stale,
+                # or a file ends in an incomplete record that must go before appending.
+                self._Load(repair=True)
+            for listing in listings:
+                id = listing.id()
+                if id is None:
+                    continue
+                if id not in self.id_nums:
+                    self.id_nums[id] = len(self.ids)
+                    self.ids.append(id)
+                    new_ids.append(id)
+                id_num = self.id_nums[id]
+                rent = _Rent(listing)
+                active = bool(listing.active)
+                flags = (_ACTIVE if active else 0) | (_RENT_KNOWN if rent is not None else 0)
+                prev = self.last.get(id_num)
+                # Unknown rent is stored as the previous value, so it costs one byte.
+                rent = rent if rent is not None else (prev[1] if prev else 0)
+                if prev is None:
+                    firstseen = _Seconds(listing.firstseen) if listing.firstseen else t
+                    if not active and listing.firstseen:
+                        # Already gone by the time history started: record when it was on the market.
+                        self._EncodeEvent(id_num, firstseen, rent, flags | _ACTIVE, events)
+                        written += 1
+                        firstseen = _Seconds(listing.lastseen) if listing.lastseen else t
+                    self._EncodeEvent(id_num, firstseen, rent, flags, events)
+                    written += 1
+                    continue
+                if prev[2] == flags and prev[1] == rent:
+                    continue
+                event_time = t
+                if prev[2] & _ACTIVE and not active and listing.lastseen:
+                    event_time = _Seconds(listing.lastseen)
+                self._EncodeEvent(id_num, event_time, rent, flags, events)
+                written += 1
+            run = bytearray()
+            _EncodeVarint(max(0, t - (self.runs[-1] if self.runs else 0)), run)
+            self.runs.append(t)
+            with open(self._Path("ids.txt"), "a") as f:
+                f.write("".join("%s\n" % id for id in new_ids))
+            with open(self._Path("events.bin"), "ab") as f:
+                f.write(events)
+            with open(self._Path("runs.bin"), "ab") as f:
+                f.write(run)
+            self.sizes = self.complete = self._Sizes()
+        return written
+
+    def Events(self, id: Optional[str] = None) -> Iterator[Tuple[str, int, Optional[int], bool]]:
+        """Yields (id, time, rent, active) in the order events were recorded."""
+        id_num = None if id is None else self.id_nums.get(id, -1)
+        for i in range(len(self.event_ids)):
+            if id_num is not None and self.event_ids[i] != id_num:
+                continue
+            rent = self.event_rents[i]
+            yield (self.ids[self.event_ids[i]], self.event_times[i],
+                   None if rent < 0 else rent, bool(self.event_flags[i] & _ACTIVE))
+
+    def DaysOnMarket(self) -> Dict[str, float]:
+        """Days each listing has been on the market: first seen to last seen, up to the latest run."""
+        seconds: Dict[int, int] = {}
+        active_since: Dict[int, int] = {}
+        for i in range(len(self.event_ids)):
+            id_num, t = self.event_ids[i], self.event_times[i]
+            active = self.event_flags[i] & _ACTIVE
+            seconds.setdefault(id_num, 0)
+            if active and id_num not in active_since:
+                active_since[id_num] = t
+            elif not active and id_num in active_since:
+                # Deactivations are dated by the listing's lastseen.
+                seconds[id_num] += t - active_since.pop(id_num)
+        latest = self.runs[-1] if self.runs else 0
+        for id_num, since in active_since.items():
+            seconds[id_num] += latest - since
+        return {self.ids[id_num]: s / 86400.0 for id_num, s in seconds.items()}
+
+    def RentChanges(self, since=None) -> List[RentChange]:
+        since = _Seconds(since) if since is not None else None
+        changes = []
+        prev_rent: Dict[int, int] = {}
+        for i in range(len(self.event_ids)):
+            id_num, rent = self.event_ids[i], self.event_rents[i]
+            if rent < 0:
+                continue
+            old = prev_rent.get(id_num)
+            prev_rent[id_num] = rent
+            if old is None or old == rent:
+                continue
+            if since is not None and self.event_times[i] < since:
+                continue
+            changes.append(RentChange(self.ids[id_num], self.event_times[i], old, rent))
+        return changes
+
+    def Export(self, f):
+        """Writes every event as csv."""
+        writer = csv.writer(f)
+        writer.writerow(["id", "timestamp", "rent", "active"])
+        for id, t, rent, active in self.Events():
+            writer.writerow([id, datetime.datetime.fromtimestamp(t).isoformat(),
+                             "" if rent is None else rent, int(active)])
+
+
+# Loaded histories, reloaded when any of their files changes size.
+_histories: Dict[str, ListingHistory] = {}
+_history_sizes: Dict[str, Tuple[int, int, int]] = {}
+_histories_lock = threading.Lock()
+
+
+def GetHistory(directory) -> Optional[ListingHistory]:
+    """Returns the history in directory for reading, or None if nothing was recorded there yet."""
+    if not os.path.isdir(directory):
+        return None
+    sizes = _FileSizes(directory)
+    with _histories_lock:
+        if _history_sizes.get(directory) != sizes:
+            start = time.time()
+            _histories[directory] = ListingHistory(directory)
+            _history_sizes[directory] = sizes
+            print("Loaded %d history events from %s in %.2fs" % (
+                len(_histories[directory].event_ids), directory, time.time() - start))
+        return _histories[directory]
+
+
+def main():
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory")
+    parser.add_argument("--export", action="store_true", help="Write all events to stdout as csv.")
+    args = parser.parse_args()
+    history = ListingHistory(args.directory)
+    if args.export:
+        history.Export(sys.stdout)
+        return
+    print("%d listings, %d events, %d runs" % (len(history.ids), len(history.event_ids), len(history.runs)))
+    for change in history.RentChanges():
+        print("%s %s %d -> %d" % (change.id, datetime.datetime.fromtimestamp(change.timestamp), change.old, change.new))
+    days = history.DaysOnMarket()
+    for id in sorted(days, key=days.get, reverse=True)[:20]:
+        print("%8.1f days  %s" % (days[id], id))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,8 @@ import argparse
 import collections
 import datetime
 import itertools
-import jsonpickle
 import locale
+import math
 import os
 import re
 import shutil
@@ -16,23 +16,29 @@ from typing import Any, Dict, Generator, Iterable, List, Optional
 
 import recordclass as recordclass
 import requests
-from bs4 import BeautifulSoup
-from flask import Flask
-from googleapiclient.discovery import build
-from httpcache import CachingHTTPAdapter
-from httplib2 import Http
-from oauth2client import client, file, tools
+from flask import Flask, Response, after_this_request, jsonify, request, send_file, stream_with_context
 from requests.packages.urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 
+from archive import ArchiveDir, PageArchive
 from emailer import Emailer
-from fetcher import Fetcher, ListingCache
-from listing import LISTING_FIELDS, Listing
-from sheets import SheetsRenderer
+import export
+from fetcher import Fetcher, ListingCache, ParseSerpSoup
+from history import GetHistory, ListingHistory, LocalHistoryPath
+from listing import LISTING_FIELDS, Listing, ParsedNumber
+from pipeline import WarmParsePool
+from profiling import InstallProfiling
+from sheets import GetSheetsService, SheetsRenderer
+from store import GetStore, IterDb, ListingStore, LocalDbPath, Query
+
+# bs4, jsonpickle, sendgrid and the Google API client are imported where they
+# are used rather than here, so that a cold instance only pays for the modules
+# the route it is serving needs. /_ah/warmup loads them ahead of time.
 
 # If `entrypoint` is not defined in app.yaml, App Engine will look for an app
 # called `app` in `main.py`.
 app = Flask(__name__)
+InstallProfiling(app)
 
 retry_strategy = Retry(
     total=3,
@@ -44,6 +50,7 @@ s = requests.Session()
 s.mount("https://", adapter)
 s.mount("http://", adapter)
 
+#from httpcache import CachingHTTPAdapter
 #http_cache = CachingHTTPAdapter(capacity=1000)
 #s.mount("http://", http_cache)
 #s.mount("https://", http_cache)
@@ -53,6 +60,7 @@ locale.setlocale(locale.LC_ALL, "ja_JP.UTF-8")
 SCOPES = "https://www.googleapis.com/auth/spreadsheets"
 SPREADSHEET_ID = "1KDESi_sl0COPlf3nKGeeNxXfH9j3BBpUq2mlaHZgKgo"
 DB_SPREADSHEET_ID = "1mLyhK5IwUDfQlrEvZCYJwVAltG2Kuriy0olrT9mTwxQ"
+SEARCH_MAX_LIMIT = 1000
 
 
 def ParseListingSummary(li) -> Listing:
@@ -72,7 +80,7 @@ class Scraper(object):
     self.host = host
     self.path = path
     self.renderer = SheetsRenderer(spreadsheet_id)
-    self.fetcher: Fetcher = Fetcher(s, self.host)
+    self.fetcher: Fetcher = Fetcher(s, self.host, PageArchive(ArchiveDir(host)))
     self.listing_cache: ListingCache = ListingCache("/tmp/cache-%s" % host, self.fetcher)
     self.emailer = Emailer(self.host, "/tmp/email_log")
     self.timestamp = timestamp
@@ -85,6 +93,7 @@ class Scraper(object):
     f = lambda x: dict(formulaValue=x)
     for field in fields:
       if field == "pickle":
+        import jsonpickle
         yield s(jsonpickle.encode(listing))
         continue
       if field == "id":
@@ -114,40 +123,19 @@ class Scraper(object):
       yield from ParseListingSummary(item)
 
   def GetSummariesFromSerp(self, soup):
-    result_list = soup.find("div", class_="result_list")
-    assert result_list
-    for result in result_list.find_all("div", class_="base"):
-      room_table = result.find("table", class_="room")
-      if room_table:
-        for row in room_table.find_all("tr", class_="clickableRow"):
-          match = re.match(r"location.href='(.*)';", row["onclick"])
-          if not match:
-            print("ERROR: invalid onclick string: [%s]" % row["onclick"])
-            continue
-          yield Listing(link=match.group(1))
-      else:
-        link_a = result.find("a")
-        if not link_a:
-          print("No link in result: [%s]" % result)
-        assert link_a
-        link = link_a["href"]
-        print("ERROR: No room table in result, falling back to building-level link [%s]" % link)
-        yield Listing(link=link)
-    pager = soup.find("div", class_="pager")
-    next_li = pager.find("li", class_="next")
-    next_a = next_li.find("a")
-    if not next_a:
-      print("This was the last page of results")
+    links, next_link = ParseSerpSoup(soup)
+    for link in links:
+      yield Listing(link=link)
+    if not next_link:
       return
-    next_url = "http://%s%s" % (self.host, next_a["href"])
-    print("Moving on to next result page: %s" % next_url)
-    page = s.get(next_url)
-    next_soup = BeautifulSoup(page.content, "html.parser")
-    yield from self.GetSummariesFromSerp(next_soup)
+    print("Moving on to next result page: http://%s%s" % (self.host, next_link))
+    # Later pages are fetched and parsed by the fetcher's pipeline.
+    yield from self.fetcher.FetchSerp(next_link)
 
   def FetchSummaries(self) -> List[Listing]:
     url = "http://" + self.host + self.path
     print("Rescan triggered for url %s" % url)
+    from bs4 import BeautifulSoup
     page = s.get(url)
     soup = BeautifulSoup(page.content, "html.parser")
 
@@ -160,12 +148,16 @@ class Scraper(object):
     raise ValueError("Unrecognized start page at %s" % url)
 
   def Rescan(self) -> Generator[Listing, None, None]:
-    for summary in self.FetchSummaries():
-      for listing in self.listing_cache.FetchCached(summary.link):
-        yield listing
+    links = [summary.link for summary in self.FetchSummaries()]
+    yield from self.listing_cache.FetchCachedMany(links)
 
   def UpdateDb(self, db: Dict[str, Listing], counters):
-    for summary in self.FetchSummaries():
+    summaries = list(self.FetchSummaries())
+    # Fill the cache for all new rooms at once, so the loop below only reads it.
+    new_links = [summary.link for summary in summaries if summary.id() not in db.keys()]
+    for _ in self.listing_cache.FetchCachedMany(new_links):
+      pass
+    for summary in summaries:
       counters["total_active"] += 1
       id = summary.id()
       if id not in db.keys():
@@ -226,6 +218,7 @@ class Scraper(object):
 
   def ReadSiteMap(self):
     url = "http://%s" % self.host
+    from bs4 import BeautifulSoup
     page = s.get(url)
     soup = BeautifulSoup(page.content, "html.parser")
     sitemap_div = soup.find("div", class_="sitemap")
@@ -236,6 +229,20 @@ class Scraper(object):
       yield a["href"]
 
 
+@app.route('/_ah/warmup')
+def warmup():
+  """Loads the lazily imported modules and builds the Sheets client ahead of the first real request."""
+  start = time.time()
+  from bs4 import BeautifulSoup
+  import jsonpickle
+  import sendgrid.helpers.mail
+  soup = BeautifulSoup('<table summary="建物詳細"><tr><th>賃料</th><td>1,000円</td></tr></table>', "html.parser")
+  ParsedNumber.Parse(soup.find("td").text, "円")
+  jsonpickle.decode(jsonpickle.encode(Listing(link="/id/0/0")))
+  GetSheetsService()
+  WarmParsePool()
+  return "Warm (%.3fs)" % (time.time() - start)
+
 @app.route('/')
 def main():
   parser = argparse.ArgumentParser()
@@ -284,6 +291,8 @@ def scrape_and_update_db(host, subpath):
 
   db: Dict[str, Listing] = {l.id(): l for l in scraper.renderer.ReadPickleDb()}
   scraper.UpdateDb(db, counters)
+  history = ListingHistory(LocalHistoryPath(host, "/%s" % subpath))
+  counters["history_events"] += history.Record(timestamp, db.values())
   reqs = []
   row = 1
 
@@ -316,8 +325,110 @@ def scrape_and_update_db(host, subpath):
       break
   reqs.append(scraper.renderer.UpdateCellReq(row, 0, [dict(stringValue=str(f)) for f in [timestamp, counters]]))
   scraper.renderer.ExecuteReqs(reqs)
+  ListingStore.Save(LocalDbPath(host, "/%s" % subpath), db)
   return "<pre>Done. Counters:\n%s</pre>" % "\n".join(["%30s %6d" % (k, v) for k, v in sorted(counters.items())])
       
+@app.route('/search/<string:host>/<path:subpath>')
+def search_db(host, subpath):
+  """Queries the local copy of the db written by /scrape-db, e.g. ?rent_min=200000&rent_max=350000&msq_min=60&year_min=1995&active=1"""
+  start = time.time()
+  store = GetStore(LocalDbPath(host, "/%s" % subpath))
+  if store is None:
+    return "No local db for %s/%s yet, run /scrape-db first" % (host, subpath), 404
+  args = request.args
+  numbers = dict(limit=100)
+  for name, type_ in [("rent_min", float), ("rent_max", float), ("msq_min", float), ("msq_max", float),
+                      ("year_min", int), ("year_max", int), ("limit", int)]:
+    if name not in args:
+      continue
+    try:
+      numbers[name] = type_(args[name])
+    except ValueError:
+      return "Invalid %s [%s]" % (name, args[name]), 400
+    # float() accepts "nan" and "inf", which would make the filter match everything or nothing.
+    if not math.isfinite(numbers[name]):
+      return "Invalid %s [%s]" % (name, args[name]), 400
+  limit = numbers.pop("limit")
+  if not 1 <= limit <= SEARCH_MAX_LIMIT:
+    return "Invalid limit [%d], must be between 1 and %d" % (limit, SEARCH_MAX_LIMIT), 400
+  active = args.get("active")
+  query = Query(address=args.get("address"), active=None if active is None else active in ("1", "true"),
+                **numbers)
+  sort = args.get("sort", "msq")
+  if sort not in ("rent", "msq", "year"):
+    return "Invalid sort [%s]" % sort, 400
+  listings = store.Search(query, sort=sort, reverse=args.get("order", "desc") == "desc", limit=limit)
+  results = [dict(id=l.id(), link="http://%s%s" % (host, l.link), name=l.name, ldk=l.ldk,
+                  rent=l.rent.value if l.rent.parsed else None,
+                  msq=l.msq.value if l.msq.parsed else None,
+                  year=l.year, address=l.address, active=bool(l.active))
+             for l in listings]
+  return jsonify(results=results, count=len(results), total=len(store.listings),
+                 took_ms=round((time.time() - start) * 1000, 2))
+
+@app.route('/history/<string:host>/<path:subpath>')
+def listing_history(host, subpath):
+  """Per-listing history recorded by /scrape-db. ?format=csv exports every event."""
+  history = GetHistory(LocalHistoryPath(host, "/%s" % subpath))
+  if history is None:
+    return "No history for %s/%s yet, run /scrape-db first" % (host, subpath), 404
+  if request.args.get("format") == "csv":
+    import io
+    out = io.StringIO()
+    history.Export(out)
+    return Response(out.getvalue(), mimetype="text/csv")
+  id = request.args.get("id")
+  days = history.DaysOnMarket()
+  changes = history.RentChanges()
+  if id:
+    days = {id: days[id]} if id in days else {}
+    changes = [c for c in changes if c.id == id]
+  return jsonify(listings=len(history.ids), runs=len(history.runs), events=len(history.event_ids),
+                 days_on_market=days, rent_changes=[c._asdict() for c in changes])
+
+@app.route('/export/<string:host>/<path:subpath>')
+def export_db(host, subpath):
+  """Downloads the local db as ?format=ndjson|csv|parquet.
+
+  With ?source=cache it exports the whole listing cache for host instead, ignoring subpath.
+  Parquet needs pyarrow, which is not in requirements.txt; without it the route returns 501.
+  """
+  fmt = request.args.get("format", "ndjson")
+  if fmt not in export.FORMATS:
+    return "Invalid format [%s]" % fmt, 400
+  mimetype, extension = export.FORMATS[fmt]
+  if request.args.get("source") == "cache":
+    cache_dir = "/tmp/cache-%s" % host
+    if not os.path.isdir(cache_dir):
+      return "No listing cache for %s yet" % host, 404
+    listings = ListingCache(cache_dir, None).IterCached()
+    filename = "%s-cache.%s" % (host, extension)
+  else:
+    db_path = LocalDbPath(host, "/%s" % subpath)
+    if not os.path.exists(db_path):
+      return "No local db for %s/%s yet, run /scrape-db first" % (host, subpath), 404
+    listings = IterDb(db_path)
+    filename = "%s%s.%s" % (host, subpath.replace("/", "_"), extension)
+  if fmt == "parquet":
+    # Parquet needs its footer written last, so it goes through a temp file rather than the response.
+    import tempfile
+    fd, path = tempfile.mkstemp(suffix=".parquet")
+    os.close(fd)
+    try:
+      export.WriteParquet(listings, path)
+    except ImportError:
+      os.remove(path)
+      return "Parquet export needs pyarrow", 501
+
+    @after_this_request
+    def cleanup(response):
+      os.remove(path)
+      return response
+    return send_file(path, mimetype=mimetype, as_attachment=True, attachment_filename=filename)
+  stream = export.StreamNdjson if fmt == "ndjson" else export.StreamCsv
+  return Response(stream_with_context(stream(listings)), mimetype=mimetype,
+                  headers={"Content-Disposition": "attachment; filename=%s" % filename})
+
 
 if __name__ == '__main__':
     # This is used when running locally only. When deploying to Google App
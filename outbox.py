@@ -0,0 +1,178 @@
+import os
+import queue
+import threading
+import time
+import traceback
+from typing import List, Optional, Set, Tuple
+
+
+class SentLog(object):
+    """Append-only log of ids that have already been emailed.
+
+    The file is read once when the log is opened; after that lookups go
+    through an in-memory set and new ids are appended one line at a time, so
+    the cost of recording a send does not grow with the size of the log.
+    """
+
+    def __init__(self, logfile):
+        self.logfile = logfile
+        self.lock = threading.Lock()
+        self.ids: Set[str] = set()
+        if os.path.exists(logfile):
+            with open(logfile) as f:
+                self.ids = set(line for line in f.read().split("\n") if line)
+        else:
+            open(logfile, "w").close()
+
+    def __contains__(self, id) -> bool:
+        return id in self.ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def Append(self, ids: List[str]):
+        with self.lock:
+            new_ids = [id for id in ids if id not in self.ids]
+            if not new_ids:
+                return
+            with open(self.logfile, "a") as f:
+                f.write("".join("\n%s" % id for id in new_ids))
+            self.ids.update(new_ids)
+
+
+class LocalTransport(object):
+    """Stand-in for a real mail transport that just keeps the digests.
+
+    If a directory is given, every digest is also written there as an html file.
+    Set `failures` to make the next N sends fail, to exercise the retry path.
+    """
+
+    def __init__(self, directory=None, failures=0):
+        self.directory = directory
+        self.failures = failures
+        self.sent: List[List[str]] = []
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def Send(self, contents: List[str]) -> bool:
+        if self.failures > 0:
+            self.failures -= 1
+            print("LocalTransport: simulated failure for %d items" % len(contents))
+            return False
+        self.sent.append(list(contents))
+        if self.directory:
+            path = os.path.join(self.directory, "digest-%04d.html" % len(self.sent))
+            with open(path, "w") as f:
+                f.write("<br>".join(contents))
+        print("LocalTransport: stored digest of %d items" % len(contents))
+        return True
+
+
+class Outbox(object):
+    """Queues rendered listings and sends them as digests on a background thread.
+
+    Items queued within `batch_window` seconds of each other are sent as one
+    digest of at most `max_batch` items. Failed sends are retried with
+    exponential backoff; ids are only written to the sent log once the
+    transport reports success, so a digest that keeps failing is picked up
+    again the next time the same listings are queued.
+    """
+
+    def __init__(self, sent_log: SentLog, transport, batch_window=2.0, max_batch=50,
+                 max_attempts=4, backoff=5.0):
+        self.sent_log = sent_log
+        self.transport = transport
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.queue: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+        self.pending: Set[str] = set()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def Enqueue(self, id: str, html: str) -> bool:
+        """Returns True if the item was queued, False if it was already sent or queued."""
+        with self.lock:
+            if id in self.sent_log or id in self.pending:
+                return False
+            self.pending.add(id)
+            self._EnsureStarted()
+        self.queue.put((id, html))
+        return True
+
+    def Flush(self, timeout=None) -> bool:
+        """Blocks until everything queued so far has been sent or given up on."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return True
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.05)
+
+    def _EnsureStarted(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._Run, name="outbox", daemon=True)
+        self.thread.start()
+
+    def _NextBatch(self) -> List[Tuple[str, str]]:
+        batch = [self.queue.get()]
+        deadline = time.time() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _SendWithRetry(self, contents: List[str]) -> bool:
+        delay = self.backoff
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                if self.transport.Send(contents):
+                    return True
+            except Exception:
+                print(traceback.format_exc())
+            print("Outbox: send attempt %d/%d failed" % (attempt, self.max_attempts))
+            if attempt < self.max_attempts:
+                time.sleep(delay)
+                delay *= 2
+        return False
+
+    def _Run(self):
+        while True:
+            batch = self._NextBatch()
+            ids = [id for id, _ in batch]
+            try:
+                if self._SendWithRetry([html for _, html in batch]):
+                    self.sent_log.Append(ids)
+                    print("Outbox: sent digest with %d items" % len(ids))
+                else:
+                    print("ERROR: Outbox gave up on %d items: %s" % (len(ids), ids))
+            except Exception:
+                # E.g. the sent log could not be written. Keep the thread alive for the next batch.
+                print(traceback.format_exc())
+            finally:
+                with self.lock:
+                    self.pending.difference_update(ids)
+
+
+def main():
+    log = SentLog("/tmp/outbox-oneoff.log")
+    transport = LocalTransport(failures=1)
+    outbox = Outbox(log, transport, batch_window=0.1, backoff=0.1)
+    for i in range(3):
+        outbox.Enqueue("oneoff___%d" % i, "<p>item %d</p>" % i)
+    outbox.Flush(timeout=10)
+    print("Digests: %s" % transport.sent)
+    print("Sent log has %d ids" % len(log))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import collections
+import cProfile
+import concurrent.futures
+import concurrent.futures.process
+import locale
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from listing import Listing
+from profiling import ActiveProfile
+
+# What to do with a fetched page:
+#   "page": a listing or building page, building pages are expanded into their units.
+#   "unit": a listing page found on a building page.
+#   "serp": a search result page, yields summaries and follows the pager.
+# `seconds` is the parse wall time in the worker; `stats` its cProfile stats, if it was asked to profile.
+ParseResult = collections.namedtuple("ParseResult", ["link", "listings", "follow", "seconds", "stats"],
+                                     defaults=(0.0, None))
+
+# App Engine instances are small, and every worker imports bs4.
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", "2"))
+# Concurrent requests to the listing site; kept low so a crawl stays polite.
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", "2"))
+
+_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def InitParseWorker(locale_name):
+    # ParsedNumber relies on the locale for thousands separators.
+    locale.setlocale(locale.LC_ALL, locale_name)
+
+
+def GetParsePool() -> concurrent.futures.ProcessPoolExecutor:
+    """Returns the process pool shared by all pipelines, starting it on first use.
+
+    Workers come from a forkserver rather than a fork of this process, which
+    has fetch, outbox and profiler threads that may be holding locks.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("forkserver"),
+                initializer=InitParseWorker, initargs=(locale.setlocale(locale.LC_ALL),))
+        return _pool
+
+
+def _DiscardBrokenPool(pool: concurrent.futures.ProcessPoolExecutor):
+    """Drops a pool that lost a worker, so the next GetParsePool starts a new one."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def WarmParsePool():
+    """Starts the parse workers ahead of the first crawl."""
+    GetParsePool().submit(ParsePage, ("unit", "/", b"<html></html>", False)).result()
+
+
+def _Parse(kind, link, content) -> Tuple[List[Listing], List[Tuple[str, str]]]:
+    from bs4 import BeautifulSoup
+    from fetcher import ExtractUnitLinks, IsListingSoup, ParseListingSoup, ParseSerpSoup
+    soup = BeautifulSoup(content, "html.parser")
+    if kind == "serp":
+        links, next_link = ParseSerpSoup(soup)
+        return [Listing(link=l) for l in links], [("serp", next_link)] if next_link else []
+    if kind == "page" and not IsListingSoup(soup):
+        return [], [("unit", l) for l in ExtractUnitLinks(soup)]
+    return list(ParseListingSoup(soup, link)), []
+
+
+def ParsePage(task: Tuple[str, str, bytes, bool]) -> ParseResult:
+    """Parses one fetched page. Runs in a worker process.
+
+    With the profile flag set the parse runs under cProfile, and the stats
+    are sent back with the result so the request's profile can include them.
+    """
+    kind, link, content, profile = task
+    start = time.time()
+    if not profile:
+        listings, follow = _Parse(kind, link, content)
+        return ParseResult(link, listings, follow, time.time() - start)
+    profiler = cProfile.Profile()
+    listings, follow = profiler.runcall(_Parse, kind, link, content)
+    profiler.create_stats()
+    return ParseResult(link, listings, follow, time.time() - start, profiler.stats)
+
+
+class FetchPipeline(object):
+    """Fetches pages on I/O threads and parses them in a process pool.
+
+    Fetch threads take links from a bounded queue and hand the raw bytes to
+    the parse pool; at most `max_parsing` pages are fetched but not yet
+    consumed at any time, so a slow parse stage stalls fetching instead of
+    piling up pages in memory, and a slow network leaves the parsers idle
+    rather than the other way round. Links found while parsing (building
+    units, the next result page) are fed back into the fetch queue.
+    """
+
+    def __init__(self, get: Callable[[str], bytes], host, fetch_workers=None, max_parsing=32):
+        self.get = get
+        self.host = host
+        self.fetch_workers = fetch_workers or FETCH_WORKERS
+        self.max_parsing = max_parsing
+
+    def _FetchLoop(self, fetch_queue, results, parse_slots, stop, profile):
+        while not stop.is_set():
+            try:
+                kind, link = fetch_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            url = "http://%s%s" % (self.host, link)
+            print("Fetching %s" % url)
+            try:
+                content = self.get(url)
+            except Exception:
+                print(traceback.format_exc())
+                results.put((link, None))
+                continue
+            while not parse_slots.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            pool = GetParsePool()
+            try:
+                future = pool.submit(ParsePage, (kind, link, content, profile))
+            except Exception as e:
+                print("ERROR: Failed to submit %s for parsing\n%s" % (link, traceback.format_exc()))
+                if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+                    _DiscardBrokenPool(pool)
+                parse_slots.release()
+                results.put((link, None))
+                continue
+            future.add_done_callback(lambda f, link=link, pool=pool: results.put((link, f, pool)))
+
+    def Run(self, tasks: Iterable[Tuple[str, str]]) -> Iterator[Listing]:
+        """Yields listings for (kind, link) tasks in completion order."""
+        todo = collections.deque(tasks)
+        fetch_queue: "queue.Queue[Tuple[str, str]]" = queue.Queue(maxsize=self.fetch_workers * 2)
+        results: "queue.Queue" = queue.Queue()
+        parse_slots = threading.BoundedSemaphore(self.max_parsing)
+        stop = threading.Event()
+        # Run is consumed on the request thread, which is where a profile is active.
+        profile = ActiveProfile()
+        threads = [threading.Thread(target=self._FetchLoop, name="fetch-%d" % i, daemon=True,
+                                    args=(fetch_queue, results, parse_slots, stop, profile is not None))
+                   for i in range(self.fetch_workers)]
+        for thread in threads:
+            thread.start()
+        outstanding = 0
+        try:
+            while todo or outstanding:
+                while todo and not fetch_queue.full():
+                    fetch_queue.put_nowait(todo.popleft())
+                    outstanding += 1
+                try:
+                    item = results.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                outstanding -= 1
+                if item[1] is None:
+                    continue
+                link, future, pool = item
+                parse_slots.release()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print("ERROR: Failed to parse %s\n%s" % (link, traceback.format_exc()))
+                    if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+                        _DiscardBrokenPool(pool)
+                    continue
+                if profile is not None:
+                    profile.AddParse(result.seconds, result.stats)
+                todo.extend(result.follow)
+                yield from result.listings
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+
+def main():
+    import argparse
+    import requests
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="tomigaya.jp")
+    parser.add_argument("--kind", default="page", choices=["page", "unit", "serp"])
+    parser.add_argument("links", nargs="+")
+    args = parser.parse_args()
+    locale.setlocale(locale.LC_ALL, "ja_JP.UTF-8")
+    session = requests.Session()
+    pipeline = FetchPipeline(lambda url: session.get(url).content, args.host)
+    for listing in pipeline.Run([(args.kind, link) for link in args.links]):
+        print(listing)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import collections
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+PROFILE_DIR = "/tmp/profiles"
+# /tmp is instance memory, so only the newest profiles are kept.
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "20"))
+PROFILE_PARAM = "profile"
+PROFILE_HEADER = "X-Profile"
+
+
+def _IsEnabled(value: Optional[str]) -> bool:
+    return value is not None and value.strip().lower() in ("1", "true")
+
+
+# The profile of the request running on each thread, if any.
+_active = threading.local()
+
+
+def ActiveProfile() -> Optional["RequestProfile"]:
+    """Returns the profile running on this thread, or None if the request is not profiled."""
+    profile = getattr(_active, "profile", None)
+    if profile is None or profile.stopped:
+        return None
+    return profile
+
+
+def _FrameName(frame) -> str:
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class StackSampler(object):
+    """Samples the stacks of all other threads at a fixed interval, counting collapsed stacks.
+
+    Unlike cProfile this also sees the fetch threads, so time spent waiting on
+    HTTP shows up next to time spent parsing and talking to Sheets.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts: Dict[str, int] = collections.Counter()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._Run, name="stack-sampler", daemon=True)
+
+    def _Run(self):
+        own_id = threading.get_ident()
+        while not self.stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_FrameName(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.counts[";".join(reversed(stack))] += 1
+
+    def Start(self):
+        self.thread.start()
+
+    def Stop(self):
+        self.stop.set()
+        self.thread.join()
+
+    def Write(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write("%s %d\n" % (stack, count))
+
+
+class _WorkerStats(object):
+    """Lets pstats.Stats load the stats dict a parse worker sent back, like it loads a Profile."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class RequestProfile(object):
+    """cProfile of the request thread plus stack samples of the whole process for one request.
+
+    Pages parsed in the worker processes don't show up in either, so the
+    workers profile those themselves and their stats are added with AddParse
+    and written separately as <id>.parse.
+    """
+
+    def __init__(self, name: str):
+        self.id = "%s-%s" % (datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8])
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler()
+        self.start = 0.0
+        self.stopped = False
+        self.parse_pages = 0
+        self.parse_seconds = 0.0
+        self.parse_stats: List[dict] = []
+
+    def Start(self):
+        self.start = time.time()
+        self.sampler.Start()
+        _active.profile = self
+        self.profile.enable()
+
+    def AddParse(self, seconds: float, stats: Optional[dict]):
+        """Adds the wall time and cProfile stats of one page parsed in a worker."""
+        self.parse_pages += 1
+        self.parse_seconds += seconds
+        if stats:
+            self.parse_stats.append(stats)
+
+    def Stop(self) -> str:
+        """Stops profiling and writes <id>.pstats and <id>.collapsed. Returns the id."""
+        if self.stopped:
+            return self.id
+        self.stopped = True
+        self.profile.disable()
+        self.sampler.Stop()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        self.profile.dump_stats(ProfilePath(self.id, "pstats"))
+        self.sampler.Write(ProfilePath(self.id, "collapsed"))
+        if self.parse_stats:
+            pstats.Stats(*[_WorkerStats(s) for s in self.parse_stats]).dump_stats(ProfilePath(self.id, "parse"))
+        _PruneProfiles(PROFILE_KEEP)
+        print("Profile %s for %s: %.2fs, %d pages parsed in workers in %.2fs" % (
+            self.id, self.name, time.time() - self.start, self.parse_pages, self.parse_seconds))
+        return self.id
+
+
+def ProfilePath(id: str, kind: str) -> Optional[str]:
+    if not re.match(r"^[\w-]+$", id):
+        return None
+    return os.path.join(PROFILE_DIR, "%s.%s" % (id, kind))
+
+
+_prune_lock = threading.Lock()
+
+
+def _PruneProfiles(keep: int):
+    """Deletes the files of all but the `keep` most recently written profiles."""
+    with _prune_lock:
+        newest: Dict[str, float] = {}
+        for name in os.listdir(PROFILE_DIR):
+            try:
+                mtime = os.path.getmtime(os.path.join(PROFILE_DIR, name))
+            except OSError:
+                continue
+            id = name.split(".")[0]
+            newest[id] = max(mtime, newest.get(id, 0.0))
+        old = set(sorted(newest, key=newest.get, reverse=True)[keep:])
+        for name in os.listdir(PROFILE_DIR):
+            if name.split(".")[0] in old:
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, name))
+                except OSError:
+                    pass
+
+
+def ProfileSummary(id: str, limit=60) -> str:
+    out = io.StringIO()
+    stats = pstats.Stats(ProfilePath(id, "pstats"), stream=out)
+    stats.sort_stats("cumulative").print_stats(limit)
+    parse_path = ProfilePath(id, "parse")
+    if os.path.exists(parse_path):
+        out.write("\nParse workers:\n")
+        stats = pstats.Stats(parse_path, stream=out)
+        stats.sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+def InstallProfiling(app):
+    """Lets any route be profiled with ?profile=1 (or true) or an X-Profile: 1 header.
+
+    The profile id is returned in the X-Profile-Id response header, and the
+    results are served from /profiles/<id> (text summary), with ?kind=pstats,
+    ?kind=parse (the parse workers' pstats) or ?kind=collapsed for the raw files. Profiling stops when the response is
+    closed, so streamed bodies such as /export are included. Requests without
+    the flag only pay for checking it.
+    """
+    from flask import Response, g, request, send_file
+
+    @app.before_request
+    def _StartProfile():
+        if not (_IsEnabled(request.args.get(PROFILE_PARAM)) or _IsEnabled(request.headers.get(PROFILE_HEADER))):
+            return
+        if request.endpoint == "get_profile":
+            return
+        g.request_profile = RequestProfile(request.path)
+        g.request_profile.Start()
+
+    @app.after_request
+    def _StopProfile(response):
+        profile = g.pop("request_profile", None)
+        if profile is not None:
+            response.headers["X-Profile-Id"] = profile.id
+            # A streamed body is only produced after this hook returns.
+            response.call_on_close(profile.Stop)
+        return response
+
+    @app.teardown_request
+    def _StopProfileOnError(exception):
+        # Only reached with a profile still in g if after_request never ran.
+        profile = g.pop("request_profile", None)
+        if profile is not None:
+            profile.Stop()
+
+    @app.route("/profiles/<string:id>")
+    def get_profile(id):
+        kind = request.args.get("kind", "text")
+        path = ProfilePath(id, "pstats")
+        if path is None or not os.path.exists(path):
+            return "No profile %s" % id, 404
+        if kind == "pstats":
+            return send_file(path, mimetype="application/octet-stream", as_attachment=True,
+                             attachment_filename="%s.pstats" % id)
+        if kind == "parse":
+            parse_path = ProfilePath(id, "parse")
+            if not os.path.exists(parse_path):
+                return "No parse profile for %s" % id, 404
+            return send_file(parse_path, mimetype="application/octet-stream", as_attachment=True,
+                             attachment_filename="%s.parse.pstats" % id)
+        if kind == "collapsed":
+            return send_file(ProfilePath(id, "collapsed"), mimetype="text/plain")
+        return Response(ProfileSummary(id), mimetype="text/plain")
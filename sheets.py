@@ -1,6 +1,3 @@
-from oauth2client import file, client, tools
-from googleapiclient.discovery import build
-from httplib2 import Http
 from listing import Listing
 from typing import Any, List, Dict, Optional
 import json
@@ -8,14 +5,32 @@ import pprint
 import os
 import shutil
 import stat
-import jsonpickle
+import threading
 
 
 SCOPES = "https://www.googleapis.com/auth/spreadsheets"
 
 
-class SheetsRenderer(object):
-    def __init__(self, spreadsheet_id):
+# httplib2.Http is not thread-safe, so every thread gets its own client.
+_local = threading.local()
+_build_lock = threading.Lock()
+
+
+def GetSheetsService():
+    """Returns this thread's Sheets API client, building it on first use.
+
+    The Google API client libraries are slow to import and the discovery
+    document is slow to load, so both happen once per thread instead of once
+    per SheetsRenderer. Builds are serialized so concurrent requests don't
+    race on copying the token or running the auth flow.
+    """
+    service = getattr(_local, "service", None)
+    if service is not None:
+        return service
+    with _build_lock:
+        from oauth2client import file, client, tools
+        from googleapiclient.discovery import build
+        from httplib2 import Http
         if not os.path.exists("/tmp/token.json"):
             shutil.copy("token.json", "/tmp/token.json")
             os.chmod(
@@ -29,7 +44,13 @@ class SheetsRenderer(object):
         if not creds or creds.invalid:
             flow = client.flow_from_clientsecrets("credentials.json", SCOPES)
             creds = tools.run_flow(flow, store)
-        self.service = build("sheets", "v4", http=creds.authorize(Http()))
+        _local.service = build("sheets", "v4", http=creds.authorize(Http()))
+    return _local.service
+
+
+class SheetsRenderer(object):
+    def __init__(self, spreadsheet_id):
+        self.service = GetSheetsService()
         self.spreadsheet_id = spreadsheet_id
         self.sheet_id = 0
         self.sheet_name = ""
@@ -149,6 +170,7 @@ class SheetsRenderer(object):
         print("Reading PickleDb from %s sheet %d (%s)" % (self.spreadsheet_id, self.sheet_id, self.sheet_name))
         col, _ = self.FindColumn("pickle")
         pickle_values = self.ReadRange("%s2:%s" % (col, col), majorDimension="COLUMNS")
+        import jsonpickle
         return [jsonpickle.decode(p) for p in pickle_values]
 
 
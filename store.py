@@ -0,0 +1,199 @@
+import bisect
+import collections
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from listing import Listing
+
+# Flat values indexed for every listing; None where the listing has no usable value.
+Row = collections.namedtuple("Row", ["rent", "msq", "year", "address", "active"])
+
+Query = collections.namedtuple(
+    "Query",
+    ["rent_min", "rent_max", "msq_min", "msq_max", "year_min", "year_max", "address", "active"],
+    defaults=(None,) * 8,
+)
+
+
+def LocalDbPath(host: str, subpath: str) -> str:
+    return "/tmp/db-%s%s" % (host, subpath.replace("/", "_"))
+
+
+def IterDb(path: str) -> Iterator[Listing]:
+    """Reads a db written by ListingStore.Save one listing at a time."""
+    import jsonpickle
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield jsonpickle.decode(line)
+
+
+def _ParsedValue(number) -> Optional[float]:
+    if number is None or not getattr(number, "parsed", False):
+        return None
+    return number.value
+
+
+def _Year(year: Optional[str]) -> Optional[int]:
+    try:
+        return int(year[:4])
+    except (TypeError, ValueError):
+        return None
+
+
+def ToRow(listing: Listing) -> Row:
+    return Row(
+        rent=_ParsedValue(listing.rent),
+        msq=_ParsedValue(listing.msq),
+        year=_Year(listing.year),
+        address=listing.address,
+        active=bool(listing.active),
+    )
+
+
+class SortedIndex(object):
+    """Ids sorted by one column, for range lookups with bisect. Listings without a value are left out."""
+
+    def __init__(self, rows: Dict[str, Row], column: str):
+        pairs = sorted((getattr(row, column), id) for id, row in rows.items()
+                       if getattr(row, column) is not None)
+        self.keys = [key for key, _ in pairs]
+        self.ids = [id for _, id in pairs]
+
+    def _Bounds(self, lo, hi):
+        start = 0 if lo is None else bisect.bisect_left(self.keys, lo)
+        end = len(self.keys) if hi is None else bisect.bisect_right(self.keys, hi)
+        return start, max(start, end)
+
+    def Count(self, lo, hi) -> int:
+        start, end = self._Bounds(lo, hi)
+        return end - start
+
+    def Range(self, lo, hi) -> List[str]:
+        start, end = self._Bounds(lo, hi)
+        return self.ids[start:end]
+
+
+class ListingStore(object):
+    """In-memory listing db with sorted secondary indexes on rent, msq, year and address.
+
+    A query walks only the narrowest index range that applies to it and checks
+    the remaining conditions row by row, so it never scans the whole db unless
+    no condition is given.
+    """
+
+    def __init__(self, listings: List[Listing]):
+        self.listings: Dict[str, Listing] = {}
+        for listing in listings:
+            id = listing.id()
+            if id is not None:
+                self.listings[id] = listing
+        self.rows: Dict[str, Row] = {id: ToRow(l) for id, l in self.listings.items()}
+        self.indexes = {column: SortedIndex(self.rows, column)
+                        for column in ("rent", "msq", "year", "address")}
+        self.active = set(id for id, row in self.rows.items() if row.active)
+
+    @staticmethod
+    def Save(path: str, db: Dict[str, Listing]):
+        """Writes one jsonpickled listing per line, so the file can be read back as a stream."""
+        import jsonpickle
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "w") as f:
+            for listing in db.values():
+                f.write(jsonpickle.encode(listing))
+                f.write("\n")
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def Load(path: str) -> "ListingStore":
+        return ListingStore(list(IterDb(path)))
+
+    def _Candidates(self, query: Query) -> List[str]:
+        ranges = []
+        for column in ("rent", "msq", "year"):
+            lo, hi = getattr(query, column + "_min"), getattr(query, column + "_max")
+            if lo is not None or hi is not None:
+                ranges.append((self.indexes[column].Count(lo, hi), column, lo, hi))
+        if query.address:
+            lo, hi = query.address, query.address + "\uffff"
+            ranges.append((self.indexes["address"].Count(lo, hi), "address", lo, hi))
+        if query.active:
+            ranges.append((len(self.active), "active", None, None))
+        if not ranges:
+            return list(self.rows.keys())
+        _, column, lo, hi = min(ranges)
+        if column == "active":
+            return list(self.active)
+        return self.indexes[column].Range(lo, hi)
+
+    @staticmethod
+    def _Matches(row: Row, query: Query) -> bool:
+        for column in ("rent", "msq", "year"):
+            value = getattr(row, column)
+            lo, hi = getattr(query, column + "_min"), getattr(query, column + "_max")
+            if lo is None and hi is None:
+                continue
+            if value is None or (lo is not None and value < lo) or (hi is not None and value > hi):
+                return False
+        if query.address and not (row.address or "").startswith(query.address):
+            return False
+        if query.active is not None and row.active != query.active:
+            return False
+        return True
+
+    def Search(self, query: Query, sort="msq", reverse=True, limit=100) -> List[Listing]:
+        ids = [id for id in self._Candidates(query) if self._Matches(self.rows[id], query)]
+        if sort:
+            missing = float("-inf") if reverse else float("inf")
+
+            def Key(id):
+                value = getattr(self.rows[id], sort)
+                return (missing if value is None else value, id)
+            ids.sort(key=Key, reverse=reverse)
+        return [self.listings[id] for id in ids[:limit]]
+
+
+# Loaded stores, reloaded when the file on disk changes.
+_stores: Dict[str, ListingStore] = {}
+_store_mtimes: Dict[str, float] = {}
+_stores_lock = threading.Lock()
+
+
+def GetStore(path: str) -> Optional[ListingStore]:
+    if not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    with _stores_lock:
+        if _store_mtimes.get(path) != mtime:
+            start = time.time()
+            _stores[path] = ListingStore.Load(path)
+            _store_mtimes[path] = mtime
+            print("Loaded %d listings from %s in %.2fs" % (len(_stores[path].listings), path, time.time() - start))
+        return _stores[path]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--rent_min", type=float)
+    parser.add_argument("--rent_max", type=float)
+    parser.add_argument("--msq_min", type=float)
+    parser.add_argument("--year_min", type=int)
+    parser.add_argument("--address")
+    parser.add_argument("--active", action="store_true", default=None)
+    args = parser.parse_args()
+    store = GetStore(args.path)
+    query = Query(rent_min=args.rent_min, rent_max=args.rent_max, msq_min=args.msq_min,
+                  year_min=args.year_min, address=args.address, active=args.active)
+    start = time.time()
+    results = store.Search(query)
+    print("%d results in %.1fms" % (len(results), (time.time() - start) * 1000))
+    for listing in results:
+        print(listing.id(), listing.rent, listing.msq, listing.year, listing.address)
+
+
+if __name__ == "__main__":
+    main()